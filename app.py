@@ -11,8 +11,14 @@
 - 「❌ 全て外す」ボタンでお気に入り一括解除
 """
 
-import io, re, time
+import hashlib, re, time
+from collections import defaultdict
+from functools import reduce
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import requests
 import streamlit as st
 from pathlib import Path
@@ -22,8 +28,7 @@ st.set_page_config(page_title="論文検索（統一UI版）", layout="wide")
 
 
 # -------------------- コントラスト（著者ドロップダウン強化版） --------------------
-st.markdown(
-    """
+APP_CSS = """
     <style>
     /* ========= テキスト入力欄（枠線あり） ========= */
     .stTextInput input, .stNumberInput input, textarea {
@@ -111,10 +116,16 @@ st.markdown(
       background: #333;
     }
     </style>
-    """,
-    unsafe_allow_html=True
+"""
 
-)
+@st.cache_resource(show_spinner=False)
+def _inject_css() -> str:
+    """APP_CSS からコメント・余分な空白を除いた送信用 CSS（初回のみ生成）"""
+    css = re.sub(r"/\*.*?\*/", "", APP_CSS, flags=re.S)
+    return re.sub(r"\s+", " ", css).strip()
+
+# 再実行のたびに送られるので、最小化済みの文字列を使う
+st.markdown(_inject_css(), unsafe_allow_html=True)
 
 # -------------------- 定数 --------------------
 KEY_COLS = [
@@ -128,6 +139,7 @@ BASE_COLS = [
     "対象物_top3","研究タイプ_top3",
     "llm_keywords","primary_keywords","secondary_keywords","featured_keywords",
 ]
+CATEGORY_COLS = ["巻数", "号数", "発行年", "対象物_top3", "研究タイプ_top3"]
 TARGET_ORDER = [
     "清酒","ビール","ワイン","焼酎","アルコール飲料","発酵乳・乳製品",
     "醤油","味噌","発酵食品","農産物・果実","副産物・バイオマス","酵母・微生物","アミノ酸・タンパク質","その他"
@@ -139,35 +151,155 @@ TYPE_ORDER = [
 ]
 
 # -------------------- ユーティリティ --------------------
+WS_RE = re.compile(r"\s+")
+TOKEN_SPLIT_RE = re.compile(r"[ ,，、；;　]+")
+
 def norm_space(s: str) -> str:
     s = str(s or "")
     s = s.replace("\u00A0", " ")
-    return re.sub(r"\s+", " ", s).strip()
+    return WS_RE.sub(" ", s).strip()
 
 def norm_key(s: str) -> str:
     return norm_space(s).lower()
 
+def on_categories(s: pd.Series, func) -> pd.Series:
+    """category 列なら func をカテゴリ値（重複なし）にだけ適用し、コードで全行に展開する。
+    欠損（コード -1）は末尾に足した NaN の結果を使う。category 以外はそのまま func(s)。
+    """
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        return func(s)
+    vals = func(pd.Series(list(s.cat.categories) + [np.nan], dtype=object))
+    return pd.Series(vals.to_numpy()[s.cat.codes.to_numpy()], index=s.index, dtype=vals.dtype)
+
+def norm_key_series(s: pd.Series) -> pd.Series:
+    """norm_key の Series 版（pandas の str 演算で一括処理）"""
+    return on_categories(s, lambda v: (
+        v.fillna("").astype(str)
+         .str.replace("\u00A0", " ", regex=False)
+         .str.replace(WS_RE, " ", regex=True)
+         .str.strip()
+         .str.lower()
+    ))
+
 AUTHOR_SPLIT_RE = re.compile(r"[;；,、，/／|｜]+")
+MULTI_SPLIT_RE = re.compile(r"[;；,、，/／|｜\s　]+")
+DIGIT_RE = re.compile(r"(\d+)")
+ROMAN_RE = re.compile(r"[A-Za-z]")
+KATAKANA_RE = re.compile(r"[\u30A0-\u30FF]")
 def split_authors(cell):
     if not cell: return []
     return [w.strip() for w in AUTHOR_SPLIT_RE.split(str(cell)) if w.strip()]
 
 def split_multi(s):
     if not s: return []
-    return [w.strip() for w in re.split(r"[;；,、，/／|｜\s　]+", str(s)) if w.strip()]
+    return [w.strip() for w in MULTI_SPLIT_RE.split(str(s)) if w.strip()]
 
+KATA2HIRA = {k: k - 0x60 for k in range(0x30A1, 0x30F7)}  # str.translate 用（ァ..ヶ → ぁ..ゖ）
 def tokens_from_query(q):
     q = norm_key(q)
-    return [t for t in re.split(r"[ ,，、；;　]+", q) if t]
+    return [t for t in TOKEN_SPLIT_RE.split(q) if t]
+
+# pandas.read_csv の既定と同じ欠損値表記
+CSV_NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+# 画面・検索・出力のどこでも使わない列（make_visible_cols で非表示になる位置にあるときだけ読み込み時に捨てる）
+DROP_COLS = {
+    "相対PASS", "終了ページ", "file_path", "num_pages",
+    "対象物_all", "対象物_根拠", "研究タイプ_all", "研究タイプ_根拠",
+}
+HIDDEN_COLS = {"相対PASS", "終了ページ", "file_path", "num_pages", "file_name"}  # 位置によらず非表示の列
+
+def used_cols(names: list[str]) -> list[bool]:
+    """列名リスト → 各列を残すか。DROP_COLS のうち、どのみち非表示になる列
+    （HIDDEN_COLS か llm_keywords 以降）だけを捨て、表示される位置にあれば残す。
+    """
+    cut = names.index("llm_keywords") if "llm_keywords" in names else len(names)
+    return [not (c in DROP_COLS and (c in HIDDEN_COLS or i >= cut)) for i, c in enumerate(names)]
+
+def dedup_col_names(names: list[str]) -> list[str]:
+    """pd.read_csv と同じ列名の付け方：空の列名は "Unnamed: i"、重複は "名前.1", "名前.2"… にする"""
+    out = [name or f"Unnamed: {i}" for i, name in enumerate(names)]
+    unnamed = [i for i, name in enumerate(names) if not name]
+    counts = defaultdict(int)
+    # pandas と同じく、名前のある列を先に確定し、空だった列の側に番号を付ける
+    for i in [i for i, name in enumerate(names) if name] + unnamed:
+        base = name = out[i]
+        cur = counts[base]
+        while cur > 0:  # 付けた名前がヘッダ内の他の列名とも重ならないよう、空くまで番号を進める
+            counts[base] = cur + 1
+            name = f"{base}.{cur}"
+            cur = cur + 1 if name in out else counts[name]
+        out[i] = name
+        counts[name] = cur + 1
+    return out
+
+def read_csv_fast(src, usecols=None) -> pd.DataFrame:
+    """CSV（UTF-8）を pyarrow のマルチスレッドパーサで読み込む。
+    欠損値・全空列・日付文字列の扱いは pd.read_csv の既定に合わせる。
+    usecols（列名リスト → 各列を残すかの bool リスト）を渡すと、pandas へ変換する前に不要列を捨てる。
+    """
+    if not hasattr(src, "read"):  # ローカルのパスはメモリマップで開く（read で中間バッファに写さない）
+        with pa.memory_map(str(src)) as mm:
+            return read_csv_fast(mm, usecols)
+    def read(column_types=None):
+        return pacsv.read_csv(
+            src,
+            parse_options=pacsv.ParseOptions(newlines_in_values=True),  # セル内改行（summary 等）
+            convert_options=pacsv.ConvertOptions(
+                strings_can_be_null=True, null_values=CSV_NA_VALUES, column_types=column_types,
+            ),
+        )
+    tbl = read()
+    # pyarrow は日付らしい文字列を日付型にするが、pandas は文字列のまま → 該当列だけ文字列で読み直す
+    temporal = {f.name: pa.string() for f in tbl.schema if pa.types.is_temporal(f.type)}
+    if temporal:
+        if src.seekable():
+            src.seek(0)
+            tbl = read(temporal)
+        else:
+            # 読み直せないストリーム（HTTP 応答など）は ISO 表記の文字列へキャストで代用
+            tbl = tbl.cast(pa.schema([
+                pa.field(f.name, pa.string()) if f.name in temporal else f for f in tbl.schema
+            ]))
+    # Arrow は列名をそのまま使う → 空・重複の列名を pandas と同じ規則で一意にする（末尾の ",," 列など）
+    tbl = tbl.rename_columns(dedup_col_names([str(name).strip() for name in tbl.column_names]))
+    if usecols is not None:
+        keep = usecols(tbl.column_names)
+        tbl = tbl.select([i for i, k in enumerate(keep) if k])
+    # 全て空の列は pandas と同じく float（NaN）列に
+    tbl = tbl.cast(pa.schema([
+        pa.field(f.name, pa.float64()) if pa.types.is_null(f.type) else f for f in tbl.schema
+    ]))
+    return tbl.to_pandas()
+
+# app.py は再実行のたびに新しいモジュールとして実行されるので、Session は cache_resource で保持する
+@st.cache_resource(show_spinner=False)
+def http_session() -> requests.Session:
+    """URL 読み込み用の共有 Session（再実行・再読込をまたいで接続（TLS）を使い回す）"""
+    return requests.Session()
 
 def fetch_csv(url: str) -> pd.DataFrame:
-    r = requests.get(url, timeout=30)
-    r.raise_for_status()
-    return pd.read_csv(io.BytesIO(r.content), encoding="utf-8")
+    """応答本体をメモリに溜めず、ストリームのまま pyarrow に読ませる"""
+    with http_session().get(url, timeout=30, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True  # gzip 等の Content-Encoding を展開して渡す
+        return read_csv_fast(r.raw, usecols=used_cols)
 
 def ensure_cols(df: pd.DataFrame) -> pd.DataFrame:
     df = df.copy()
     df.columns = [str(c).strip() for c in df.columns]
+    df = add_int_cols(compact_dtypes(df))
+    df["_row_id"] = make_row_ids(df)  # 行IDも読み込み時に一度だけ付与（表示・お気に入りで共通利用）
+    return df
+
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """値の種類が少ない列を category にしてメモリと比較コストを下げる"""
+    for c in CATEGORY_COLS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
     return df
 
 def consolidate_authors_column(df: pd.DataFrame) -> pd.DataFrame:
@@ -175,20 +307,25 @@ def consolidate_authors_column(df: pd.DataFrame) -> pd.DataFrame:
     if "著者" not in df.columns:
         return df
     df = df.copy()
-    def unify(cell: str) -> str:
-        names = split_authors(cell)
-        seen = set()
-        result = []
-        for n in names:
-            k = norm_key(n)
-            if not k or k in seen:
-                continue
-            seen.add(k)
-            result.append(n)
-        return ", ".join(result)
-    df["著者"] = df["著者"].astype(str).apply(unify)
+    cells = df["著者"].astype(str)
+    # 同じセル値は1度だけ処理（著者列は重複が多い）
+    mapping = {cell: _unify_author_cell(cell) for cell in cells.unique()}
+    df["著者"] = cells.map(mapping)
     return df
 
+def _unify_author_cell(cell: str, _split=AUTHOR_SPLIT_RE.split, _norm=norm_key) -> str:
+    """著者セル1つ分：区切り記号で分割し、正規化キーが重複する表記を除いて ", " で連結"""
+    seen = set()
+    result = []
+    for n in _split(cell):
+        n = n.strip()
+        k = _norm(n)
+        if not k or k in seen:
+            continue
+        seen.add(k)
+        result.append(n)
+    return ", ".join(result)
+
 def build_author_candidates(df: pd.DataFrame):
     rep = {}
     for v in df.get("著者", pd.Series(dtype=str)).fillna(""):
@@ -198,20 +335,181 @@ def build_author_candidates(df: pd.DataFrame):
                 rep[k] = name
     return [rep[k] for k in sorted(rep.keys())]
 
-def haystack(row):
-    parts = [
-        str(row.get("論文タイトル","")),
-        str(row.get("著者","")),
-        str(row.get("file_name","")),
-        " ".join(str(row.get(c,"")) for c in KEY_COLS if c in row),
-    ]
-    return norm_key(" \n ".join(parts))
-
-def to_int_or_none(x):
-    try: return int(str(x).strip())
-    except Exception:
-        m = re.search(r"\d+", str(x))
-        return int(m.group()) if m else None
+def df_signature(df: pd.DataFrame) -> str:
+    """キャッシュキー用の内容ハッシュ（読み込み時に finish_load で1度だけ計算し、各キャッシュ関数には df 本体を渡さない）。
+    "_" 始まりの内部列は元の列から決まるので、ハッシュは元の列だけで取る。
+    """
+    src = df[[c for c in df.columns if not str(c).startswith("_")]]
+    h = hashlib.sha1(pd.util.hash_pandas_object(src, index=True).to_numpy().tobytes())
+    h.update("\x1f".join(map(str, df.columns)).encode("utf-8"))
+    return h.hexdigest()
+
+@st.cache_data(ttl=600, max_entries=8, show_spinner=False)  # 1件が表全体の CSV なので少なめに
+def to_csv_bytes(key: tuple, _df: pd.DataFrame) -> bytes:
+    """ダウンロード用 CSV（Excel 向けに BOM 付き UTF-8）。key（_df の中身を決める値）が同じなら再シリアライズしない"""
+    return _df.to_csv(index=False).encode("utf-8-sig")
+
+def build_candidates(df: pd.DataFrame) -> dict:
+    """フィルタ候補（対象物/研究タイプ/巻/号/著者）。読み込み時に1度だけ作る（finish_load 経由）"""
+    vol_int, iss_int = df["_巻数_i"], df["_号数_i"]
+    raw_targets = {t for v in df.get("対象物_top3", pd.Series(dtype=str)).dropna().unique() for t in split_multi(v)}
+    raw_types = {t for v in df.get("研究タイプ_top3", pd.Series(dtype=str)).dropna().unique() for t in split_multi(v)}
+    return {
+        "targets": order_by_template(list(raw_targets), TARGET_ORDER),
+        "types": order_by_template(list(raw_types), TYPE_ORDER),
+        "vols": sorted(vol_int.dropna().unique().astype(int).tolist()),
+        "issues": sorted(iss_int.dropna().unique().astype(int).tolist()),
+        "authors": build_author_candidates(df),
+    }
+
+SEARCH_COLS = ["論文タイトル", "著者", "file_name", *KEY_COLS]  # キーワード検索の対象列（本文 pdf_text は別扱い）
+
+# 読み取り専用の Series を毎回コピーしないよう cache_resource で共有（df 本体には列として付けない）
+@st.cache_resource(ttl=600, show_spinner=False)
+def build_search_text(df_sig: str, _df: pd.DataFrame) -> tuple[pd.Series, pd.Series | None]:
+    """キーワード検索用の正規化済み文字列（読み込み内容ごとに一度だけ作る）。
+    戻り値は (SEARCH_COLS を連結して norm_key 相当に正規化したもの, 本文 pdf_text の正規化（列がなければ None）)。
+    """
+    cols = [c for c in SEARCH_COLS if c in _df.columns]
+    if cols:
+        # 空セル（NaN）は "" にする：以前のように文字列 "nan" として検索に当たることはない
+        parts = [_df[c].fillna("").astype(str) for c in cols]
+        hs = parts[0].str.cat(parts[1:], sep=" \n ") if len(parts) > 1 else parts[0]
+        search_n = norm_key_series(hs)
+    else:
+        search_n = pd.Series("", index=_df.index, dtype=object)
+    pdf_n = norm_key_series(_df["pdf_text"]) if "pdf_text" in _df.columns else None
+    return search_n, pdf_n
+
+@st.cache_resource(ttl=600, show_spinner=False)
+def build_haystack(df_sig: str, _df: pd.DataFrame, include_fulltext: bool = False) -> pd.Series:
+    """キーワード検索用：行ごとの検索対象文字列（正規化済み・df.index 揃え）。
+    include_fulltext=True なら本文も後ろに連結する（トークンは空白を含まないので区切りは空白1つ）。
+    """
+    search_n, pdf_n = build_search_text(df_sig, _df)
+    if include_fulltext and pdf_n is not None:
+        return search_n.str.cat(pdf_n, sep=" ")
+    return search_n
+
+EMPTY_POSTING = np.empty(0, dtype=np.int32)
+
+# 読み取り専用の索引を毎回コピーしないよう cache_resource で共有
+@st.cache_resource(ttl=600, show_spinner=False)
+def build_inverted_index(
+    df_sig: str, _df: pd.DataFrame, include_fulltext: bool = False,
+) -> tuple[dict[str, int], np.ndarray, np.ndarray]:
+    """キーワード検索用の文字 unigram/bigram 転置索引（CSR 形式）。
+    日本語は単語区切りがないので、語ではなく文字単位で索引して部分一致を保つ。
+    戻り値は (gram → id, offsets, rows)：id の行番号は rows[offsets[id]:offsets[id + 1]]（昇順 int32）。
+    gram ごとに小さな配列を持つより、連続した2本の配列のほうがメモリも作成時間も小さい。
+    """
+    grams, counts = [], []
+    for h in build_haystack(df_sig, _df, include_fulltext):
+        gs = {*h, *(h[j:j + 2] for j in range(len(h) - 1))}
+        grams.extend(gs)
+        counts.append(len(gs))
+    gram_ids, uniques = pd.factorize(pd.Series(grams, dtype=object))  # gram → id 付けはハッシュ表で一括
+    row_ids = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+    order = np.argsort(gram_ids, kind="stable")  # 安定ソートなので各 gram 内の行番号は昇順のまま
+    offsets = np.zeros(len(uniques) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(gram_ids, minlength=len(uniques)), out=offsets[1:])
+    vocab = dict(zip(uniques, range(len(uniques))))
+    return vocab, offsets, row_ids[order]
+
+@st.cache_resource(ttl=600, show_spinner=False)
+def build_haystack_arrow(df_sig: str, _df: pd.DataFrame, include_fulltext: bool = False) -> pa.Array:
+    """build_haystack を Arrow 文字列配列にしたもの（OR 検索の正規表現照合用、読み取り専用で共有）"""
+    return pa.array(build_haystack(df_sig, _df, include_fulltext).tolist(), type=pa.large_string())
+
+def keyword_hit_positions(
+    df_sig: str, _df: pd.DataFrame, toks: list[str], mode: str, include_fulltext: bool = False,
+) -> np.ndarray:
+    """キーワード一致行の行番号（_df 内の位置）。
+    索引で候補行を絞り、3文字以上のトークンだけ候補行を部分一致で確認する
+    （1〜2文字は索引そのものが一致行なので確認不要）。
+    """
+    hay = build_haystack(df_sig, _df, include_fulltext)
+    vocab, offsets, rows_all = build_inverted_index(df_sig, _df, include_fulltext)
+
+    def posting(g):
+        gid = vocab.get(g)
+        return EMPTY_POSTING if gid is None else rows_all[offsets[gid]:offsets[gid + 1]]
+
+    def intersect(a, b):
+        return np.intersect1d(a, b, assume_unique=True)  # posting は重複なし
+
+    def candidates(t):
+        if len(t) <= 2:
+            return posting(t)
+        # 出現行の少ない bigram から積集合を取ると、途中の配列が早く小さくなる
+        return reduce(intersect, sorted((posting(t[i:i + 2]) for i in range(len(t) - 1)), key=len))
+
+    def verify(rows, ts):
+        # 渡された順（候補の少ない＝絞り込みの強いトークンから）に確認し、残った行だけ次へ回す
+        for t in ts:
+            if not len(rows):
+                break
+            if len(t) > 2:
+                rows = rows[hay.iloc[rows].str.contains(t, regex=False).to_numpy(dtype=bool)]
+        return rows
+
+    if mode == "AND":
+        cands = sorted(((candidates(t), t) for t in toks), key=lambda c: len(c[0]))
+        return verify(reduce(intersect, (c for c, _ in cands)), [t for _, t in cands])
+    # OR：1〜2文字はそのまま索引、3文字以上は候補行の和集合を1つの正規表現（選択 |）で1回だけ走査。
+    # 照合は Arrow（RE2）で C++ 側に任せる（GIL を持たず、Python の re より速い）
+    hits = [posting(t) for t in toks if len(t) <= 2]
+    long_toks = [t for t in toks if len(t) > 2]
+    if long_toks:
+        rows = reduce(np.union1d, (candidates(t) for t in long_toks))
+        if len(rows):
+            pat = "|".join(map(re.escape, long_toks))
+            hay_arr = build_haystack_arrow(df_sig, _df, include_fulltext)
+            rows = rows[pc.match_substring_regex(hay_arr.take(rows), pat).to_numpy(zero_copy_only=False)]
+        hits.append(rows)
+    return reduce(np.union1d, hits)
+
+def author_key_set(cell) -> frozenset:
+    """著者セル → 正規化済み著者キーの集合"""
+    return frozenset(k for k in (norm_key(w) for w in AUTHOR_SPLIT_RE.split(str(cell))) if k)
+
+def label_key_set(cell) -> frozenset:
+    """対象物/研究タイプ セル → 正規化済みラベルの集合（候補リストと同じ split_multi で分割）"""
+    return frozenset(k for k in (norm_key(w) for w in split_multi(cell)) if k)
+
+SET_COLS = {"著者": ("authors", author_key_set),
+            "対象物_top3": ("targets", label_key_set),
+            "研究タイプ_top3": ("types", label_key_set)}  # 元列 → (集合のキー, 変換)
+
+# 読み取り専用の Series を毎回コピーしないよう cache_resource で共有（df 本体には列として付けない）
+@st.cache_resource(ttl=600, show_spinner=False)
+def build_filter_sets(df_sig: str, _df: pd.DataFrame) -> dict[str, pd.Series]:
+    """著者/対象物/研究タイプ フィルタ用の frozenset の Series（読み込み内容ごとに一度だけ作る）。
+    値の種類ごとに1回だけ変換する。
+    """
+    sets = {}
+    for col, (key, to_set) in SET_COLS.items():
+        if col not in _df.columns:
+            sets[key] = pd.Series([frozenset()] * len(_df), index=_df.index, dtype=object)
+            continue
+        vals = _df[col].astype(object).where(_df[col].notna(), "")
+        memo = {v: to_set(v) for v in pd.unique(vals)}
+        sets[key] = pd.Series([memo[v] for v in vals], index=_df.index, dtype=object)
+    return sets
+
+def to_int_series(s: pd.Series) -> pd.Series:
+    """数値化：各セルの最初の数字列を整数に（該当なしは <NA>、nullable Int64）"""
+    return on_categories(s, lambda v: pd.to_numeric(
+        v.astype(str).str.extract(DIGIT_RE, expand=False), errors="coerce"
+    ).astype("Int64"))
+
+INT_COLS = {"巻数": "_巻数_i", "号数": "_号数_i", "発行年": "_発行年_i"}  # 元列 → 整数化した列
+
+def add_int_cols(df: pd.DataFrame) -> pd.DataFrame:
+    """巻・号・年フィルタ用の Int64 列を読み込み時に一度だけ付ける（元列がなければ全て <NA>）"""
+    for col, icol in INT_COLS.items():
+        df[icol] = to_int_series(df[col]) if col in df.columns else pd.Series(pd.NA, index=df.index, dtype="Int64")
+    return df
 
 def order_by_template(values, template):
     """1) テンプレの順 2) 未収載はアルファ順 3) その他は最後"""
@@ -227,21 +525,23 @@ def make_visible_cols(df: pd.DataFrame) -> list[str]:
     """df の列から『相対PASS/終了ページ/file_path/num_pages/file_name』と
        『llm_keywords 以降の全列』を非表示対象にして、表示列リストを返す。
     """
-    base_hide = {"相対PASS", "終了ページ", "file_path", "num_pages", "file_name"}
     cols = [str(c) for c in df.columns]
-    hide = set(c for c in cols if c in base_hide)
+    hide = set(c for c in cols if c in HIDDEN_COLS or c.startswith("_"))  # "_" 始まりは内部列
     if "llm_keywords" in cols:
         idx = cols.index("llm_keywords")
         hide.update(cols[idx:])
     return [c for c in cols if c not in hide]
 
-def make_row_id(row):
-    no = str(row.get("No.", "")).strip()
-    if no and no.lower() not in {"none", "nan"}:
-        return f"NO:{no}"
-    ttl = str(row.get("論文タイトル", "")).strip()
-    yr  = str(row.get("発行年", "")).strip()
-    return f"T:{ttl}|Y:{yr}"
+def make_row_ids(df: pd.DataFrame) -> pd.Series:
+    """行ID（お気に入りのキー）：No. があれば "NO:<No.>"、なければ "T:<タイトル>|Y:<発行年>" """
+    def col(name):
+        if name not in df.columns:
+            return pd.Series("", index=df.index, dtype=object)
+        return df[name].astype(str).str.strip()
+    no_str = col("No.")
+    has_no = no_str.ne("") & ~no_str.str.lower().isin({"none", "nan"})
+    ids = np.where(has_no, "NO:" + no_str, "T:" + col("論文タイトル") + "|Y:" + col("発行年"))
+    return pd.Series(ids, index=df.index, dtype=object)
 
 # -------------------- データ読み込み --------------------
 st.title("醸造協会誌　論文検索 β_2.1")
@@ -252,13 +552,19 @@ AUTHORS_CSV_PATH = Path("data/authors_readings.csv")  # ← 追加: 著者読み
 
 SECRET_URL = st.secrets.get("GSHEET_CSV_URL", "")  # （任意）Secretsに入れておけば自動使用
 
+def finish_load(df: pd.DataFrame) -> tuple[pd.DataFrame, str, dict]:
+    """読み込み後の共通仕上げ：内容ハッシュと候補リストを作り、df と一緒に返す
+    （ローダのキャッシュに載るので再実行のたびには計算しない）
+    """
+    return df, df_signature(df), build_candidates(df)
+
 @st.cache_data(ttl=600, show_spinner=False)
-def load_local_csv(path: Path) -> pd.DataFrame:
-    return ensure_cols(pd.read_csv(path, encoding="utf-8"))
+def load_local_csv(path: Path) -> tuple[pd.DataFrame, str, dict]:
+    return finish_load(load_or_build_parquet(path))
 
 @st.cache_data(ttl=600, show_spinner=False)
-def load_url_csv(url: str) -> pd.DataFrame:
-    return ensure_cols(fetch_csv(url))
+def load_url_csv(url: str) -> tuple[pd.DataFrame, str, dict]:
+    return finish_load(attach_summaries(ensure_cols(fetch_csv(url))))
 
 # --- 追加：summaries.csv ローダ ---
 @st.cache_data(ttl=600, show_spinner=False)
@@ -266,7 +572,7 @@ def load_summaries(path: Path) -> pd.DataFrame | None:
     try:
         if not path.exists():
             return None
-        df_s = pd.read_csv(path, encoding="utf-8")
+        df_s = read_csv_fast(path, usecols=lambda names: [c in ("file_name", "summary") for c in names])
         df_s.columns = [str(c).strip() for c in df_s.columns]
         if not {"file_name", "summary"}.issubset(df_s.columns):
             return None
@@ -274,13 +580,48 @@ def load_summaries(path: Path) -> pd.DataFrame | None:
     except Exception:
         return None
 
+def attach_summaries(df: pd.DataFrame) -> pd.DataFrame:
+    """summaries.csv があれば file_name で summary 列をマージ"""
+    sum_df = load_summaries(SUMMARY_CSV_PATH)
+    if sum_df is not None and "file_name" in df.columns:
+        df = df.merge(sum_df, on="file_name", how="left")
+    return df
+
+PARQUET_PREP_VERSION = 6  # 読み込み後の前処理（dtype 等）を変えたら上げる → 古い parquet は作り直し
+
+def load_or_build_parquet(csv_path: Path) -> pd.DataFrame:
+    """ローカルCSVを読み込み（列名整形・summary マージ済み）。
+    同名の .parquet が CSV / summaries.csv より新しければそれを読み、なければ作って保存する。
+    """
+    parq = csv_path.with_suffix(".parquet")
+    src_mtime = max(p.stat().st_mtime for p in (csv_path, SUMMARY_CSV_PATH) if p.exists())
+    if parq.exists() and parq.stat().st_mtime >= src_mtime:
+        try:
+            df = pd.read_parquet(parq, engine="pyarrow", memory_map=True)
+            if df.attrs.get("prep_version") != PARQUET_PREP_VERSION:
+                raise ValueError("outdated parquet")
+            # parquet の文字列欠損は None で戻るので、CSV 読み込み時と同じ NaN に揃える
+            obj = df.select_dtypes(include="object").columns
+            df[obj] = df[obj].where(df[obj].notna(), np.nan)
+            # 数値の category は parquet から元の型で戻るので付け直す
+            return compact_dtypes(df)
+        except Exception:
+            pass  # 壊れている等 → CSV から作り直す
+    df = attach_summaries(ensure_cols(read_csv_fast(csv_path, usecols=used_cols)))
+    df.attrs["prep_version"] = PARQUET_PREP_VERSION
+    try:
+        df.to_parquet(parq, engine="pyarrow", compression="zstd", index=False)
+    except Exception:
+        pass  # 書き込めない環境でも CSV 読み込みだけで動かす
+    return df
+
 # --- 追加：authors_readings.csv ローダ ---
 @st.cache_data(ttl=600, show_spinner=False)
 def load_authors_readings(path: Path) -> pd.DataFrame | None:
     try:
         if not path.exists():
             return None
-        adf = pd.read_csv(path, encoding="utf-8")
+        adf = read_csv_fast(path)
         adf.columns = [str(c).strip() for c in adf.columns]
         if not {"author", "reading"}.issubset(adf.columns):
             return None
@@ -314,18 +655,18 @@ err = None
 try:
     if load_clicked:
         if up is not None:
-            df = ensure_cols(pd.read_csv(up, encoding="utf-8"))
+            df, df_sig, candidates = finish_load(attach_summaries(ensure_cols(read_csv_fast(up, usecols=used_cols))))
             st.toast("ローカルCSVを読み込みました")
         elif url.strip():
-            df = load_url_csv(url.strip())
+            df, df_sig, candidates = load_url_csv(url.strip())
             st.toast("URLのCSVを読み込みました")
         else:
             st.warning("URL または CSV を指定してください。")
     elif use_demo and DEMO_CSV_PATH.exists():
-        df = load_local_csv(DEMO_CSV_PATH)
+        df, df_sig, candidates = load_local_csv(DEMO_CSV_PATH)
         st.caption(f"✅ デモCSVを自動ロード中: {DEMO_CSV_PATH}")
     elif SECRET_URL:
-        df = load_url_csv(SECRET_URL)
+        df, df_sig, candidates = load_url_csv(SECRET_URL)
         st.caption("✅ SecretsのURLから自動ロード中")
 except Exception as e:
     err = e
@@ -336,15 +677,10 @@ if df is None:
     st.info("左のサイドバーで CSV を指定するか、デモCSVを有効にしてください。")
     st.stop()
 
-# --- 追加：summary をマージ ---
-sum_df = load_summaries(SUMMARY_CSV_PATH)
-if sum_df is not None:
-    df = df.merge(sum_df, on="file_name", how="left")
-
 # -------------------- 年・巻・号フィルタ --------------------
 st.subheader("検索フィルタ")
-year_vals = pd.to_numeric(df.get("発行年", pd.Series(dtype=str)), errors="coerce")
-if year_vals.notna().any():
+year_vals = df["_発行年_i"].dropna()
+if not year_vals.empty:
     ymin_all, ymax_all = int(year_vals.min()), int(year_vals.max())
 else:
     ymin_all, ymax_all = 1980, 2025
@@ -356,11 +692,9 @@ with c_y:
         value=(ymin_all, ymax_all)
     )
 with c_v:
-    vol_candidates = sorted({v for v in (df.get("巻数", pd.Series(dtype=str)).map(to_int_or_none)).dropna().unique()})
-    vols_sel = st.multiselect("巻（複数選択）", vol_candidates, default=[])
+    vols_sel = st.multiselect("巻（複数選択）", candidates["vols"], default=[])
 with c_i:
-    iss_candidates = sorted({v for v in (df.get("号数", pd.Series(dtype=str)).map(to_int_or_none)).dropna().unique()})
-    issues_sel = st.multiselect("号（複数選択）", iss_candidates, default=[])
+    issues_sel = st.multiselect("号（複数選択）", candidates["issues"], default=[])
 
 # -------------------- 検索フィルタ（1段目：対象物 / 研究タイプ） --------------------
 #st.subheader("検索フィルタ")
@@ -368,14 +702,10 @@ with c_i:
 row1_tg, row1_tp = st.columns([1.2, 1.2])
 
 with row1_tg:
-    raw_targets = {t for v in df.get("対象物_top3", pd.Series(dtype=str)).fillna("") for t in split_multi(v)}
-    targets_all = order_by_template(list(raw_targets), TARGET_ORDER)
-    targets_sel = st.multiselect("対象物（複数選択／部分一致）", targets_all, default=[])
+    targets_sel = st.multiselect("対象物（複数選択／部分一致）", candidates["targets"], default=[])
 
 with row1_tp:
-    raw_types = {t for v in df.get("研究タイプ_top3", pd.Series(dtype=str)).fillna("") for t in split_multi(v)}
-    types_all = order_by_template(list(raw_types), TYPE_ORDER)
-    types_sel = st.multiselect("研究タイプ（複数選択／部分一致）", types_all, default=[])
+    types_sel = st.multiselect("研究タイプ（複数選択／部分一致）", candidates["types"], default=[])
 
 # -------------------- 検索フィルタ（2段目：著者 + イニシャルラジオ横並び） --------------------
 row2_author, row2_radio = st.columns([1.0, 2.0])   # ← 著者欄を短めにしてラジオに幅を多めに
@@ -397,7 +727,7 @@ ini = st.session_state["author_initial"]
 with row2_author:
     adf = load_authors_readings(AUTHORS_CSV_PATH)
     if adf is not None and not adf.empty:
-        cand = adf.copy()
+        cand = adf  # 絞り込み・並び替えはいずれも新しい DataFrame を返すのでコピー不要
 
         # --- （以下は従来と同じフィルタ＆並び替え処理）---
         GOJUON = {
@@ -413,46 +743,29 @@ with row2_author:
             "わ": "わをん",
         }
 
-        def kata_to_hira(s: str) -> str:
-            out = []
-            for ch in str(s or ""):
-                o = ord(ch)
-                if 0x30A1 <= o <= 0x30F6:
-                    out.append(chr(o - 0x60))
-                else:
-                    out.append(ch)
-            return "".join(out)
-
-        def hira_head(s: str) -> str | None:
-            s = str(s or "")
-            return kata_to_hira(s)[0] if s else None
-
-        def is_roman_head(s: str) -> bool:
-            return bool(re.match(r"[A-Za-z]", str(s or "")))
-
         ini = st.session_state.author_initial
         if ini == "英字":
-            cand = cand[cand["reading"].astype(str).str.match(r"[A-Za-z]")]
+            cand = cand[cand["reading"].astype(str).str.match(ROMAN_RE)]
         elif ini != "すべて":
-            allowed = set(GOJUON.get(ini, ""))
-            cand = cand[cand["reading"].apply(
-                lambda s: (not is_roman_head(s)) and (hira_head(s) in allowed if hira_head(s) else False)
-            )]
+            # 先頭1文字だけカタカナ→ひらがな変換して五十音行と照合（英字・空は自然に不一致）
+            head = cand["reading"].fillna("").astype(str).str[:1].str.translate(KATA2HIRA)
+            cand = cand[head.isin(set(GOJUON.get(ini, ""))).to_numpy()]
 
         # 並び順
         AIUEO_ORDER = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
         def sort_tuple(reading: str):
             if not reading: return (3, 999, "")
             ch = reading[0]
-            if re.match(r"[A-Za-z]", ch): return (2, 999, ch.lower())
-            if re.match(r"[\u30A0-\u30FF]", ch): return (1, 999, reading)
+            if ROMAN_RE.match(ch): return (2, 999, ch.lower())
+            if KATAKANA_RE.match(ch): return (1, 999, reading)
             idx = AIUEO_ORDER.find(ch)
             return (0, idx if idx != -1 else 998, reading)
 
+        sort_keys = [sort_tuple(r) for r in cand["reading"]]
         cand = cand.assign(
-            _grp=[sort_tuple(r)[0] for r in cand["reading"]],
-            _key=[sort_tuple(r)[1] for r in cand["reading"]],
-            _sub=[sort_tuple(r)[2] for r in cand["reading"]],
+            _grp=[k[0] for k in sort_keys],
+            _key=[k[1] for k in sort_keys],
+            _sub=[k[2] for k in sort_keys],
         ).sort_values(by=["_grp","_key","_sub"], kind="mergesort").drop(columns=["_grp","_key","_sub"])
 
         reading2author = dict(zip(cand["reading"], cand["author"]))
@@ -466,8 +779,7 @@ with row2_author:
         )
         authors_sel = sorted({reading2author[r] for r in authors_sel_readings}) if authors_sel_readings else []
     else:
-        authors_all = build_author_candidates(df)
-        authors_sel = st.multiselect("著者", authors_all, default=[])
+        authors_sel = st.multiselect("著者", candidates["authors"], default=[])
 
 # 念のため未定義ガード
 if 'authors_sel' not in locals(): authors_sel = []
@@ -480,37 +792,70 @@ with kw_row1:
     kw_query = st.text_input("キーワード（空白/カンマで複数可）", value="")
 with kw_row2:
     kw_mode = st.radio("一致条件", ["OR", "AND"], index=0, horizontal=True, key="kw_mode")
+# 本文列があるデータだけ「本文も検索」を出す（既定はオフ：索引が大きくなるため）
+include_fulltext = (
+    st.checkbox("本文（pdf_text）も検索対象にする", value=False, key="include_fulltext")
+    if "pdf_text" in df.columns else False
+)
 
 
 # -------------------- フィルタ適用 --------------------
-def apply_filters(_df: pd.DataFrame) -> pd.DataFrame:
-    df2 = _df.copy()
-    if "発行年" in df2.columns:
-        y = pd.to_numeric(df2["発行年"], errors="coerce")
-        df2 = df2[(y >= y_from) & (y <= y_to) | y.isna()]
-    if vols_sel and "巻数" in df2.columns:
-        df2 = df2[df2["巻数"].map(to_int_or_none).isin(set(vols_sel))]
-    if issues_sel and "号数" in df2.columns:
-        df2 = df2[df2["号数"].map(to_int_or_none).isin(set(issues_sel))]
-    if authors_sel and "著者" in df2.columns:
-        sel = {norm_key(a) for a in authors_sel}
-        def hit_author(v): return any(norm_key(x) in sel for x in split_authors(v))
-        df2 = df2[df2["著者"].apply(hit_author)]
-    if targets_sel and "対象物_top3" in df2.columns:
-        t_norm = [norm_key(t) for t in targets_sel]
-        df2 = df2[df2["対象物_top3"].apply(lambda v: any(t in norm_key(v) for t in t_norm))]
-    if types_sel and "研究タイプ_top3" in df2.columns:
-        t_norm = [norm_key(t) for t in types_sel]
-        df2 = df2[df2["研究タイプ_top3"].apply(lambda v: any(t in norm_key(v) for t in t_norm))]
+@st.cache_data(ttl=300, max_entries=32, show_spinner=False)
+def apply_filters(
+    df_sig: str, _df: pd.DataFrame,
+    y_from: int, y_to: int,
+    vols_sel: tuple, issues_sel: tuple, authors_sel: tuple, targets_sel: tuple, types_sel: tuple,
+    kw_query: str, kw_mode: str, include_fulltext: bool = False,
+) -> np.ndarray:
+    """フィルタ適用。引数（df_sig＋各条件）が同じなら前回の結果を返す（★/tags 操作だけの再実行では走らない）。
+    キャッシュを小さく保つため、DataFrame ではなく一致行の位置（_df 内の行番号）を返す。
+    """
+    cols = _df.columns
+    mask = np.ones(len(_df), dtype=bool)  # 条件ごとに絞り込みを重ね、最後に位置だけ返す（途中でコピーを作らない）
+
+    def narrow(key, pred):
+        # Python 側の判定（集合演算）は、まだ残っている行にだけ行う
+        alive = np.flatnonzero(mask)
+        ok = build_filter_sets(df_sig, _df)[key].iloc[alive].map(pred).to_numpy(dtype=bool)
+        mask[alive[~ok]] = False
+
+    def label_pred(key, sel):
+        # 部分一致：選択語を含むラベルを全て集め、行のラベル集合と交わるかで判定
+        t_norm = [norm_key(t) for t in sel]
+        labels = frozenset().union(*build_filter_sets(df_sig, _df)[key])
+        want = frozenset(l for l in labels if any(t in l for t in t_norm))
+        return lambda s: not s.isdisjoint(want)
+
+    if "発行年" in cols:
+        y = _df["_発行年_i"]
+        mask &= ((y >= y_from) & (y <= y_to) | y.isna()).to_numpy(dtype=bool)
+    if vols_sel and "巻数" in cols:
+        mask &= _df["_巻数_i"].isin(vols_sel).to_numpy(dtype=bool)
+    if issues_sel and "号数" in cols:
+        mask &= _df["_号数_i"].isin(issues_sel).to_numpy(dtype=bool)
+    if authors_sel and "著者" in cols:
+        sel = frozenset(norm_key(a) for a in authors_sel)
+        narrow("authors", lambda s: not s.isdisjoint(sel))
+    if targets_sel and "対象物_top3" in cols:
+        narrow("targets", label_pred("targets", targets_sel))
+    if types_sel and "研究タイプ_top3" in cols:
+        narrow("types", label_pred("types", types_sel))
     toks = tokens_from_query(kw_query)
     if toks:
-        def hit_kw(row):
-            hs = haystack(row)
-            return all(t in hs for t in toks) if kw_mode == "AND" else any(t in hs for t in toks)
-        df2 = df2[df2.apply(hit_kw, axis=1)]
-    return df2
-
-filtered = apply_filters(df)
+        hit = np.zeros(len(_df), dtype=bool)
+        hit[keyword_hit_positions(df_sig, _df, toks, kw_mode, include_fulltext)] = True
+        mask &= hit
+    return np.flatnonzero(mask)
+
+filter_args = (
+    y_from, y_to,
+    tuple(sorted(vols_sel)), tuple(sorted(issues_sel)), tuple(sorted(authors_sel)),
+    tuple(sorted(targets_sel)), tuple(sorted(types_sel)),
+    kw_query, kw_mode, include_fulltext,
+)
+filter_key = (df_sig, *filter_args)  # 絞り込み結果を一意に決めるキー（CSV 出力のキャッシュにも使う）
+filtered_pos = apply_filters(df_sig, df, *filter_args)
+filtered = df.iloc[filtered_pos]
 
 # -------------------- 検索結果テーブル --------------------
 st.markdown("### 検索結果")
@@ -524,17 +869,26 @@ if "著者" in visible_cols and "summary" in filtered.columns:
     if "summary" not in visible_cols:
         visible_cols.insert(idx + 1, "summary")
 
-disp = filtered.loc[:, visible_cols].copy()
-disp["_row_id"] = disp.apply(make_row_id, axis=1)
+disp = filtered.loc[:, visible_cols + ["_row_id"]].copy()
+
+def build_tag_index(fav_tags: dict) -> dict:
+    """fav_tags（row_id -> tags）を tag -> row_id 集合の転置索引にする"""
+    index = defaultdict(set)
+    for rid, tags in fav_tags.items():
+        for t in tags:
+            index[t].add(rid)
+    return dict(index)
 
 # セッション初期化：お気に入り集合／タグ辞書
 if "favs" not in st.session_state:
     st.session_state.favs = set()
 if "fav_tags" not in st.session_state:
     st.session_state.fav_tags = {}   # row_id -> set(tags)
+if "tag_index" not in st.session_state:
+    st.session_state.tag_index = build_tag_index(st.session_state.fav_tags)   # tag -> set(row_id)
 
 # メイン表：お気に入りチェック列
-disp["★"] = disp["_row_id"].apply(lambda rid: rid in st.session_state.favs)
+disp["★"] = disp["_row_id"].isin(st.session_state.favs)
 
 # LinkColumn 設定
 column_config = {
@@ -568,10 +922,25 @@ fixed_front = ["★", "No.", "HPリンク先", "PDFリンク先"]
 rest = [c for c in disp.columns if c not in ["★", "_row_id", "No.", "HPリンク先", "PDFリンク先"]]
 display_order = fixed_front + rest + ["_row_id"]
 
+# --- ページ分割（ブラウザへ送るのは表示中のページだけ） ---
+pg1, pg2, pg3 = st.columns([1, 1, 4])
+with pg1:
+    page_size = int(st.number_input("1ページの件数", min_value=100, max_value=2000, value=500, step=100, key="main_page_size"))
+n_pages = max(1, -(-len(disp) // page_size))
+if st.session_state.get("main_page", 1) > n_pages:  # 絞り込みで件数が減ったら最終ページに寄せる
+    st.session_state.main_page = n_pages
+with pg2:
+    page = int(st.number_input("ページ", min_value=1, max_value=n_pages, step=1, key="main_page"))
+page_start = (page - 1) * page_size
+disp_page = disp.iloc[page_start:page_start + page_size]
+with pg3:
+    if len(disp):
+        st.caption(f"{page_start + 1}〜{page_start + len(disp_page)} 行目を表示（{page} / {n_pages} ページ）")
+
 # --- 表を描画 ---
 with st.form("main_table_form", clear_on_submit=False):
     edited_main = st.data_editor(
-        disp[display_order],
+        disp_page[display_order],
         key="main_editor",
         use_container_width=True,
         hide_index=True,
@@ -583,7 +952,7 @@ with st.form("main_table_form", clear_on_submit=False):
     apply_main = st.form_submit_button("チェックした論文をお気に入りリストに追加", use_container_width=True)
     
 if apply_main:
-    subset_ids_main = set(disp["_row_id"].tolist())
+    subset_ids_main = set(disp_page["_row_id"].tolist())  # 表示中のページの行だけ入れ替える
     checked_subset_main = set(edited_main.loc[edited_main["★"] == True, "_row_id"].tolist())
     st.session_state.favs = (st.session_state.favs - subset_ids_main) | checked_subset_main
 
@@ -605,136 +974,179 @@ if "著者" in visible_cols_full and "summary" in df.columns:
     if "summary" not in visible_cols_full:
         visible_cols_full.insert(idx + 1, "summary")
 
-fav_disp_full = df.loc[:, visible_cols_full].copy()
-fav_disp_full = df.loc[:, visible_cols_full].copy()
-fav_disp_full["_row_id"] = fav_disp_full.apply(make_row_id, axis=1)
-fav_disp = fav_disp_full[fav_disp_full["_row_id"].isin(st.session_state.favs)].copy()
+fav_cols = visible_cols_full + ["_row_id"]
+
+# 読み取り専用の対応表を毎回作らないよう cache_resource で共有
+@st.cache_resource(ttl=600, show_spinner=False)
+def build_row_positions(df_sig: str, _df: pd.DataFrame) -> dict:
+    """_row_id → 行位置（int 配列。万一 ID が重複しても全行を拾う）"""
+    return pd.Series(np.arange(len(_df))).groupby(_df["_row_id"].to_numpy()).indices
+
+def fav_rows(df_sig: str, df: pd.DataFrame, cols: list) -> pd.DataFrame:
+    """お気に入り行だけを必要な列で取り出す（書き込み可能な新しい DataFrame、行順は df のまま）。
+    全行を isin で走査せず、お気に入りの件数分だけ対応表を引く。
+    """
+    rid_pos = build_row_positions(df_sig, df)
+    hits = [rid_pos[rid] for rid in st.session_state.favs if rid in rid_pos]
+    pos = np.sort(np.concatenate(hits)) if hits else np.empty(0, dtype=np.intp)
+    return df.take(pos).loc[:, cols]  # 列は名前で選ぶ（先に行を絞るので少ない行だけコピー）
 
 def tags_str_for(rid: str) -> str:
     s = st.session_state.fav_tags.get(rid, set())
     return ", ".join(sorted(s)) if s else ""
 
-if not fav_disp.empty:
-    # 列名修正（開始ページ → p.始）
-    if "開始ページ" in fav_disp.columns:
-        fav_disp = fav_disp.rename(columns={"開始ページ": "p.始"})
+# -------------------- タグでお気に入りを絞り込み（AND/OR） --------------------
+@st.fragment
+def tag_filter_section(df_sig: str, df: pd.DataFrame, fav_cols: list):
+    """タグ絞り込み（タグ検索の入力はこの範囲だけ再実行）"""
+    with st.expander("🔎 タグでお気に入りを絞り込み（AND/OR）", expanded=False):
+        tag_query = st.text_input("タグ検索（カンマ/空白区切り）", key="tag_query")
+        tag_mode = st.radio("一致条件", ["OR", "AND"], index=0, horizontal=True, key="tag_mode")
+
+        fav_disp_for_filter = fav_rows(df_sig, df, fav_cols)
+        if tag_query.strip():
+            tags = [t.strip() for t in TOKEN_SPLIT_RE.split(tag_query) if t.strip()]
+            postings = [st.session_state.tag_index.get(t, set()) for t in tags]
+            matched_ids = reduce(set.intersection if tag_mode == "AND" else set.union, postings)
+            fav_disp_for_filter = fav_disp_for_filter[fav_disp_for_filter["_row_id"].isin(matched_ids).to_numpy()]
+
+        # 表示
+        def tags_str_for_filter(rid: str) -> str:
+            s = st.session_state.fav_tags.get(rid, set())
+            return ", ".join(sorted(s)) if s else ""
+        fav_disp_for_filter["tags"] = fav_disp_for_filter["_row_id"].apply(tags_str_for_filter)
+
+        show_cols = ["No.","発行年","巻数","号数","論文タイトル","著者","対象物_top3","研究タイプ","HPリンク先","PDFリンク先","tags"]
+        show_cols = [c for c in show_cols if c in fav_disp_for_filter.columns]
+        st.dataframe(fav_disp_for_filter[show_cols], use_container_width=True, hide_index=True)
+
+# -------------------- お気に入り表〜CSV出力（fragment） --------------------
+@st.fragment
+def favorites_section(
+    df_sig: str, df: pd.DataFrame, fav_cols: list, filtered_export_df: pd.DataFrame, filtered_export_key: tuple,
+):
+    """お気に入り表（★/tags 編集）・タグ絞り込み・CSV出力。
+    tags の編集はこの範囲だけ再実行し、検索フィルタ側の処理はやり直さない。
+    """
+    fav_base = fav_rows(df_sig, df, fav_cols)  # 表示・CSV出力で共用（書き換えない）
+    fav_disp = fav_base.copy()
 
-    fav_disp["★"] = fav_disp["_row_id"].apply(lambda rid: rid in st.session_state.favs)
-    fav_disp["tags"] = fav_disp["_row_id"].apply(tags_str_for)
+    if not fav_disp.empty:
+        # 列名修正（開始ページ → p.始）
+        if "開始ページ" in fav_disp.columns:
+            fav_disp = fav_disp.rename(columns={"開始ページ": "p.始"})
 
-    fav_column_config = {
-        "★": st.column_config.CheckboxColumn("★", help="チェックで解除/追加（下のボタンで反映）", default=True, width="small"),
-        "tags": st.column_config.TextColumn("tags（カンマ/空白区切り）", help="例: 清酒, 乳酸菌"),
-    }
-    if "HPリンク先" in fav_disp.columns:
-        fav_column_config["HPリンク先"] = st.column_config.LinkColumn("HP", display_text="HP")
-    if "PDFリンク先" in fav_disp.columns:
-        fav_column_config["PDFリンク先"] = st.column_config.LinkColumn("PDF", display_text="PDF")
-
-    # 列順調整
-    fixed_front = ["★", "No.", "HPリンク先", "PDFリンク先"]
-    rest = [c for c in fav_disp.columns if c not in ["★", "_row_id", "No.", "HPリンク先", "PDFリンク先", "tags"]]
-    fav_display_order = fixed_front + rest + ["tags", "_row_id"]
-
-    # 表描画
-    with st.form("fav_table_form", clear_on_submit=False):
-        fav_edited = st.data_editor(
-            fav_disp[fav_display_order],
-            key="fav_editor",
-            use_container_width=True,
-            hide_index=True,
-            column_config=fav_column_config,
-            disabled=[c for c in fav_display_order if c not in ["★", "tags"]],
-            height=420,
-            num_rows="fixed",
-        )
-        apply_fav = st.form_submit_button("お気に入りの変更（★/tags）を更新", use_container_width=True)
-
-    if apply_fav:
-        # ★の更新
-        subset_ids_fav = set(fav_disp["_row_id"].tolist())
-        fav_checked_subset = set(fav_edited.loc[fav_edited["★"] == True, "_row_id"].tolist())
-        st.session_state.favs = (st.session_state.favs - subset_ids_fav) | fav_checked_subset
-
-        # tags の更新（行ごとにテキストをパース → set に格納）
-        def parse_tags(s):
-            if not isinstance(s, str): s = str(s or "")
-            parts = [t.strip() for t in re.split(r"[ ,，、；;　]+", s) if t.strip()]
-            return set(parts)
-        for _, r in fav_edited.iterrows():
-            rid = r["_row_id"]
-            tag_set = parse_tags(r.get("tags", ""))
-            if tag_set:
-                st.session_state.fav_tags[rid] = tag_set
-            elif rid in st.session_state.fav_tags:
-                # 空にした場合は削除
-                del st.session_state.fav_tags[rid]
-
-        st.success("お気に入り（★/tags）を反映しました")
-        st.rerun()
-else:
-    st.info("お気に入りは未選択です。上の表の『★』にチェックしてから反映してください。")
-    fav_edited = None
+        fav_disp["★"] = True  # ここに並ぶのは全てお気に入り行
+        fav_disp["tags"] = fav_disp["_row_id"].apply(tags_str_for)
 
-# -------------------- タグでお気に入りを絞り込み（AND/OR） --------------------
-with st.expander("🔎 タグでお気に入りを絞り込み（AND/OR）", expanded=False):
-    tag_query = st.text_input("タグ検索（カンマ/空白区切り）", key="tag_query")
-    tag_mode = st.radio("一致条件", ["OR", "AND"], index=0, horizontal=True, key="tag_mode")
-
-    fav_disp_for_filter = fav_disp_full[fav_disp_full["_row_id"].isin(st.session_state.favs)].copy()
-    if tag_query.strip():
-        tags = [t.strip() for t in re.split(r"[ ,，、；;　]+", tag_query) if t.strip()]
-        def match_tags_row(row):
-            row_tags = st.session_state.fav_tags.get(row["_row_id"], set())
-            return all(t in row_tags for t in tags) if tag_mode == "AND" else any(t in row_tags for t in tags)
-        fav_disp_for_filter = fav_disp_for_filter[fav_disp_for_filter.apply(match_tags_row, axis=1)]
-
-    # 表示
-    def tags_str_for_filter(rid: str) -> str:
-        s = st.session_state.fav_tags.get(rid, set())
-        return ", ".join(sorted(s)) if s else ""
-    fav_disp_for_filter["tags"] = fav_disp_for_filter["_row_id"].apply(tags_str_for_filter)
+        fav_column_config = {
+            "★": st.column_config.CheckboxColumn("★", help="チェックで解除/追加（下のボタンで反映）", default=True, width="small"),
+            "tags": st.column_config.TextColumn("tags（カンマ/空白区切り）", help="例: 清酒, 乳酸菌"),
+        }
+        if "HPリンク先" in fav_disp.columns:
+            fav_column_config["HPリンク先"] = st.column_config.LinkColumn("HP", display_text="HP")
+        if "PDFリンク先" in fav_disp.columns:
+            fav_column_config["PDFリンク先"] = st.column_config.LinkColumn("PDF", display_text="PDF")
+
+        # 列順調整
+        fixed_front = ["★", "No.", "HPリンク先", "PDFリンク先"]
+        rest = [c for c in fav_disp.columns if c not in ["★", "_row_id", "No.", "HPリンク先", "PDFリンク先", "tags"]]
+        fav_display_order = fixed_front + rest + ["tags", "_row_id"]
+
+        # 表描画
+        with st.form("fav_table_form", clear_on_submit=False):
+            fav_edited = st.data_editor(
+                fav_disp[fav_display_order],
+                key="fav_editor",
+                use_container_width=True,
+                hide_index=True,
+                column_config=fav_column_config,
+                disabled=[c for c in fav_display_order if c not in ["★", "tags"]],
+                height=420,
+                num_rows="fixed",
+            )
+            apply_fav = st.form_submit_button("お気に入りの変更（★/tags）を更新", use_container_width=True)
+
+        if apply_fav:
+            # ★の更新
+            subset_ids_fav = set(fav_disp["_row_id"].tolist())
+            fav_checked_subset = set(fav_edited.loc[fav_edited["★"] == True, "_row_id"].tolist())
+            new_favs = (st.session_state.favs - subset_ids_fav) | fav_checked_subset
+            favs_changed = new_favs != st.session_state.favs
+            st.session_state.favs = new_favs
+
+            # tags の更新（行ごとにテキストをパース → set に格納）
+            def parse_tags(s):
+                if not isinstance(s, str): s = str(s or "")
+                parts = [t.strip() for t in TOKEN_SPLIT_RE.split(s) if t.strip()]
+                return set(parts)
+            fav_tags, tag_index = st.session_state.fav_tags, st.session_state.tag_index
+            for rid, tags_cell in zip(fav_edited["_row_id"].to_numpy(), fav_edited["tags"].to_numpy()):
+                tag_set = parse_tags(tags_cell)
+                old_set = fav_tags.get(rid, set())
+                if tag_set == old_set:
+                    continue
+                # 転置索引は変わったタグの分だけ更新（空になったタグは消す）
+                for t in old_set - tag_set:
+                    tag_index[t].discard(rid)
+                    if not tag_index[t]:
+                        del tag_index[t]
+                for t in tag_set - old_set:
+                    tag_index.setdefault(t, set()).add(rid)
+                if tag_set:
+                    fav_tags[rid] = tag_set
+                else:
+                    # 空にした場合は削除
+                    del fav_tags[rid]
+
+            st.success("お気に入り（★/tags）を反映しました")
+            # ★が変わったときはメイン表の★も更新するため全体を、tags だけならこの範囲だけ再実行
+            if favs_changed:
+                st.rerun()
+            st.rerun(scope="fragment")
+    else:
+        st.info("お気に入りは未選択です。上の表の『★』にチェックしてから反映してください。")
 
-    show_cols = ["No.","発行年","巻数","号数","論文タイトル","著者","対象物_top3","研究タイプ","HPリンク先","PDFリンク先","tags"]
-    show_cols = [c for c in show_cols if c in fav_disp_for_filter.columns]
-    st.dataframe(fav_disp_for_filter[show_cols], use_container_width=True, hide_index=True)
+    tag_filter_section(df_sig, df, fav_cols)
 
-# -------------------- 下部アクション（CSV出力：2種類） --------------------
-st.caption(
-    f"現在のお気に入り：{len(st.session_state.favs)} 件 / "
-    f"タグ数：{len({t for s in st.session_state.fav_tags.values() for t in s})} 種"
-)
+    # -------------------- 下部アクション（CSV出力：2種類） --------------------
+    st.caption(
+        f"現在のお気に入り：{len(st.session_state.favs)} 件 / "
+        f"タグ数：{len(st.session_state.tag_index)} 種"
+    )
 
-# 1) 絞り込み結果の出力（画面の検索結果テーブルと同じ列）
-filtered_export_df = disp.drop(columns=["★", "_row_id"], errors="ignore")
+    # お気に入りの出力（tags 列を付与）
+    fav_export = fav_base.copy()
+
+    def _tags_join(rid: str) -> str:
+        s = st.session_state.fav_tags.get(rid, set())
+        return ", ".join(sorted(s)) if s else ""
 
-# 2) お気に入りの出力（tags 列を付与）
-fav_export = fav_disp_full[fav_disp_full["_row_id"].isin(st.session_state.favs)].copy()
+    fav_export["tags"] = fav_export["_row_id"].map(_tags_join)
+    fav_export = fav_export.drop(columns=["_row_id"], errors="ignore")
 
-def _tags_join(rid: str) -> str:
-    s = st.session_state.fav_tags.get(rid, set())
-    return ", ".join(sorted(s)) if s else ""
+    c_dl1, c_dl2 = st.columns(2)
 
-fav_export["tags"] = fav_export["_row_id"].map(_tags_join)
-fav_export = fav_export.drop(columns=["_row_id"], errors="ignore")
+    with c_dl1:
+        st.download_button(
+            "📥 絞り込み結果をCSV出力（表示列のみ）",
+            data=to_csv_bytes(filtered_export_key, filtered_export_df),
+            file_name=f"filtered_{time.strftime('%Y%m%d')}.csv",
+            mime="text/csv",
+            use_container_width=True
+        )
 
-c_dl1, c_dl2 = st.columns(2)
+    with c_dl2:
+        st.download_button(
+            "⭐ お気に入りをCSV出力（tags付き）",
+            data=to_csv_bytes((df_signature(fav_export),), fav_export),  # ★/tags 次第なので小さい表の内容ハッシュで
+            file_name=f"favorites_{time.strftime('%Y%m%d')}.csv",
+            mime="text/csv",
+            use_container_width=True,
+            disabled=fav_export.empty
+        )
 
-with c_dl1:
-    st.download_button(
-        "📥 絞り込み結果をCSV出力（表示列のみ）",
-        data=filtered_export_df.to_csv(index=False).encode("utf-8-sig"),
-        file_name=f"filtered_{time.strftime('%Y%m%d')}.csv",
-        mime="text/csv",
-        use_container_width=True
-    )
+# 絞り込み結果の出力（画面の検索結果テーブルと同じ列）
+filtered_export_df = disp.drop(columns=["★", "_row_id"], errors="ignore")
 
-with c_dl2:
-    st.download_button(
-        "⭐ お気に入りをCSV出力（tags付き）",
-        data=fav_export.to_csv(index=False).encode("utf-8-sig"),
-        file_name=f"favorites_{time.strftime('%Y%m%d')}.csv",
-        mime="text/csv",
-        use_container_width=True,
-        disabled=fav_export.empty
-    )
\ No newline at end of file
+favorites_section(df_sig, df, fav_cols, filtered_export_df, (*filter_key, tuple(filtered_export_df.columns)))